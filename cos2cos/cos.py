@@ -1,84 +1,228 @@
+from ibm_boto3.s3.transfer import TransferConfig, create_transfer_manager
 from ibm_boto3.session import Session
 from ibm_botocore.client import Config
-from pathlib import PurePath
+from ibm_botocore.exceptions import BotoCoreError, ClientError
+from ibm_s3transfer.subscribers import BaseSubscriber
+import logging
+from tempfile import SpooledTemporaryFile
+
+_log = logging.getLogger(__name__)
+
+# Default size of the HTTP connection pool shared by every request made
+# through a CloudObjectStorage instance.
+MAX_POOL_CONNECTIONS = 32
+
+# Maximum number of keys accepted by a single multi-object delete request,
+# and returned by a single page of a bucket listing.
+MAX_DELETE_OBJECTS = 1000
+LIST_PAGE_SIZE = 1000
+
+# Objects smaller than this are transferred with a single request, larger
+# ones in parts of this size.
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+# Number of parts transferred at the same time, across all of the managed
+# (multipart) transfers in progress.
+MAX_TRANSFER_CONCURRENCY = 10
+
+# Largest object which can be copied with a single CopyObject request.
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+
+# Large objects downloaded in parts are kept in memory up to this size, and
+# spooled to a temporary file beyond it.  Every thread transferring a large
+# object may hold a buffer this big, so this bounds the memory used for
+# them to this size times the number of request threads plus transfer
+# workers (384 MiB with the defaults).
+MAX_SPOOL_SIZE = 16 * 1024 * 1024
 
 
 class CloudObjectStorage():
     def __init__(self, api_key=None, instance_id=None, iam_endpoint=None,
-                 cos_endpoint=None):
+                 cos_endpoint=None, max_pool_connections=MAX_POOL_CONNECTIONS):
         self.cos_endpoint = cos_endpoint
         self.session = Session(
             ibm_api_key_id=api_key,
             ibm_service_instance_id=instance_id,
             ibm_auth_endpoint=iam_endpoint)
 
-        # The COS sdk call download_file() downloads to a local file.
-        # If you have an object which implements file-like behavior
-        # (e.g. it supports write() and can store bytes)
-        # you can pass that into a call to
-        # download_fileobj() instead of download_file().
-        # You would then need to change the implemention of put_file()
-        # to call upload_fileobj() and pass in your object instead of
-        # the file name.
-
-    def get_file(self, bucket_name=None, file=None):
-        cos = self.session.resource(
+        # Build the S3 client once and reuse it for every call, so that all
+        # requests share a single pool of keep-alive connections instead of
+        # paying for a new TCP and TLS handshake on each COS operation.
+        # Unlike resources, clients are thread-safe, so this is the only
+        # object shared between the threads handling requests and transfers.
+        self.client = self.session.client(
             service_name='s3',
             endpoint_url=self.cos_endpoint,
-            config=Config(signature_version='oauth')
+            config=Config(
+                signature_version='oauth',
+                max_pool_connections=max_pool_connections,
+                tcp_keepalive=True,
+                retries={'max_attempts': 3, 'mode': 'adaptive'})
         )
-        response = cos.Bucket(bucket_name).download_file(
-            Key=PurePath(file).name,
-            Filename=file
-        )
-        return response
 
-    def put_file(self, bucket_name=None, file=None):
-        cos = self.session.resource(
-            service_name='s3',
-            endpoint_url=self.cos_endpoint,
-            config=Config(signature_version='oauth')
-        )
-        cos.Bucket(bucket_name).upload_file(file, PurePath(file).name)
+        # Settings shared by all managed (multipart capable) transfers.
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_THRESHOLD,
+            max_concurrency=MAX_TRANSFER_CONCURRENCY,
+            use_threads=True)
+        # Managed transfers all go through this one transfer manager, rather
+        # than each call starting (and tearing down) its own manager and
+        # thread pool.
+        self.transfer_manager = create_transfer_manager(
+            self.client, self.transfer_config)
+
+    # get_object_stream returns the object body as a readable stream,
+    # together with its length in bytes, so an object can be moved from one
+    # bucket to another without storing it in a local file.  Objects at or
+    # above the multipart threshold are instead downloaded in parts, in
+    # parallel, into a temporary buffer which is returned in place of the
+    # stream.  Buffers for objects larger than MAX_SPOOL_SIZE are spooled
+    # to a temporary file: for such objects this trades local disk I/O for
+    # the faster parallel download.  If size is not given it is fetched
+    # from COS first.
+
+    def get_object_stream(self, bucket_name=None, file=None, size=None):
+        if size is None:
+            size = self.client.head_object(
+                Bucket=bucket_name, Key=file)['ContentLength']
+        if size < MULTIPART_THRESHOLD:
+            response = self.client.get_object(Bucket=bucket_name, Key=file)
+            return response['Body'], response['ContentLength']
+
+        body = SpooledTemporaryFile(max_size=MAX_SPOOL_SIZE)
+        try:
+            self.transfer_manager.download(
+                bucket_name, file, body,
+                subscribers=transfer_size_subscribers(size)
+            ).result()
+        except BaseException:
+            body.close()
+            raise
+        body.seek(0)
+        return body, size
+
+    def put_object_stream(self, bucket_name=None, file=None, body=None,
+                          length=None, content_type=None):
+        extra_args = {}
+        if content_type:
+            extra_args['ContentType'] = content_type
+        if length is not None and length < MULTIPART_THRESHOLD:
+            self.client.put_object(
+                Bucket=bucket_name,
+                Key=file,
+                Body=body.read(),
+                ContentLength=length,
+                **extra_args
+            )
+        else:
+            # The transfer manager reads the stream in chunks and uploads
+            # them as parts of a multipart upload, in parallel.
+            self.transfer_manager.upload(
+                body, bucket_name, file,
+                extra_args=extra_args,
+                subscribers=transfer_size_subscribers(length)
+            ).result()
+
+    # copy_object copies an object from one bucket to another entirely
+    # within COS, so none of its data passes through this app.  Objects
+    # known to be small enough are copied with a single CopyObject request.
+    # Larger objects, or objects of unknown size, go through the transfer
+    # manager, which copies them in parts (still within COS); it has to ask
+    # COS for the size first unless size is given.
+
+    def copy_object(self, source_bucket=None, source_file=None,
+                    destination_bucket=None, destination_file=None,
+                    size=None):
+        copy_source = {'Bucket': source_bucket, 'Key': source_file}
+        if size is not None and size <= MAX_COPY_OBJECT_SIZE:
+            self.client.copy_object(
+                Bucket=destination_bucket,
+                Key=destination_file,
+                CopySource=copy_source
+            )
+        else:
+            self.transfer_manager.copy(
+                copy_source, destination_bucket, destination_file,
+                subscribers=transfer_size_subscribers(size)
+            ).result()
 
     def delete_file(self, bucket_name=None, file=None):
-        cos = self.session.resource(
-            service_name='s3',
-            endpoint_url=self.cos_endpoint,
-            config=Config(signature_version='oauth')
-        )
-        response = cos.Bucket(bucket_name).delete_objects(
-            Delete={
-                'Objects': [
-                    {'Key': file}
-                ],
-                'Quiet': True
-                },
-            MFA='string',
-            RequestPayer='requester'
-        )
-        if 'Errors' in response.keys():
+        if self.delete_files(bucket_name=bucket_name, files=[file]):
             raise COSError
 
+    # delete_files removes the given objects using as few multi-object
+    # delete requests as possible and returns the list of keys which
+    # could not be deleted.  If a whole request fails, every key in it is
+    # reported as not deleted and the remaining requests are still made.
+
+    def delete_files(self, bucket_name=None, files=None):
+        failed = []
+        for i in range(0, len(files), MAX_DELETE_OBJECTS):
+            batch = files[i:i + MAX_DELETE_OBJECTS]
+            try:
+                response = self.client.delete_objects(
+                    Bucket=bucket_name,
+                    Delete={
+                        'Objects': [{'Key': f} for f in batch],
+                        'Quiet': True
+                        },
+                    MFA='string',
+                    RequestPayer='requester'
+                )
+            except (BotoCoreError, ClientError):
+                _log.exception('Error when trying to delete %d files from '
+                               'bucket %s', len(batch), bucket_name)
+                failed.extend(batch)
+                continue
+            failed.extend(e['Key'] for e in response.get('Errors', []))
+        return failed
+
     # get_files returns a dict.  The key is the object key,
     # the value is a dict containing core object metadata.
     # See https://ibm.github.io/ibm-cos-sdk-python/reference/services/s3.html#S3.ObjectVersion
 
     def get_files_info(self, bucket_name=None):
-        cos = self.session.resource(
-            service_name='s3',
-            endpoint_url=self.cos_endpoint,
-            config=Config(signature_version='oauth')
-        )
         files = {}
-        object_summaries = cos.Bucket(bucket_name).objects.all()
-        for s in object_summaries:
-            object = s.Object()
-            files[object.key] = {'last_modified': object.last_modified,
-                                 'size': object.content_length,
-                                 'version': object.version_id}
+        for key, info in self.iter_files_info(bucket_name=bucket_name):
+            # The listing doesn't include the version ID, so fetch it from
+            # the object's metadata.
+            response = self.client.head_object(Bucket=bucket_name, Key=key)
+            info['version'] = response.get('VersionId')
+            files[key] = info
         return files
 
+    # iter_files_info yields (key, metadata) pairs for the objects in a
+    # bucket one page of the listing at a time, so callers can start
+    # working on the first objects before the whole bucket has been listed.
+    # The metadata comes straight from the listing, which doesn't include
+    # the version ID, so unlike get_files_info() no extra request is made
+    # per object.
+
+    def iter_files_info(self, bucket_name=None):
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=bucket_name,
+            PaginationConfig={'PageSize': LIST_PAGE_SIZE})
+        for page in pages:
+            for s in page.get('Contents', []):
+                yield s['Key'], {'last_modified': s['LastModified'],
+                                 'size': s['Size']}
+
+
+# TransferSizeSubscriber tells the transfer manager the size of the object
+# being transferred, which saves it from asking COS for it.
+class TransferSizeSubscriber(BaseSubscriber):
+    def __init__(self, size):
+        self.size = size
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.size)
+
+
+def transfer_size_subscribers(size):
+    return [TransferSizeSubscriber(size)] if size is not None else None
+
 
 class COSError(Exception):
     """Exception class for errors when interacting with COS."""
@@ -1,87 +1,254 @@
 import click
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from heapq import merge
+from itertools import islice
 import logging
-from os import environ
-from flask import Flask, request, abort, render_template
-from cos import CloudObjectStorage, COSError
+import threading
+import time
+from flask import Flask, request, jsonify, render_template
+from flask.json.provider import DefaultJSONProvider
+from flask_caching import Cache
+from gunicorn.app.base import BaseApplication
+import orjson
+from cos import (CloudObjectStorage, COSError, MAX_POOL_CONNECTIONS,
+                 MAX_TRANSFER_CONCURRENCY)
 
+_log = logging.getLogger(__name__)
 
-# FileHandler contains all of the file download/upload/delete logic.
+# Number of threads transferring files during cron reconciliation.
+TRANSFER_WORKERS = 16
+
+# How long (in seconds) the request IDs of handled COS events are
+# remembered, and the most that are remembered at once.
+SEEN_EVENTS_TTL = 300
+SEEN_EVENTS_MAX = 10000
+
+
+# process_file and transfer_file contain all of the file
+# download/upload/delete logic.
 # If you want to add some actual file processing, hook it in here.
-class FileHandler():
-    def __init__(self, cos_client, source_bucket, destination_bucket, file):
-        self.cos_client = cos_client
-        self.source_bucket = source_bucket
-        self.destination_bucket = destination_bucket
-        self.file = file
-
-    def do(self):
-        object = self.cos_client.get_file(
-            bucket_name=self.source_bucket,
-            file=self.file)
-
-        logging.info('File downloaded')
-        logging.info('Processing file')
-        # Since the COS object has been stored as a local file, you'd
-        # need to read that in and process it, then write the results back
-        # out to another file (or store them in a file-like object).
-        # This demo program does no actual processing of the file contents.
-        logging.info('Processing complete')
-        logging.info('Uploading file %s to COS bucket %s',
-                     self.file, self.destination_bucket)
-
-        self.cos_client.put_file(
-            bucket_name=self.destination_bucket,
-            file=self.file)
-
-        logging.info('Upload complete')
-
-        try:
-            logging.info('Deleting file %s from bucket %s',
-                         self.file, self.source_bucket)
-            self.cos_client.delete_file(
-                bucket_name=self.source_bucket, file=self.file)
-        except COSError as e:
-            logging.warning('Error when trying to delete file %s from bucket %s',
-                            self.file, self.source_bucket)
-            raise e
-
-
-def create_server(cos_client=None, destination_bucket=None, source_bucket=None):
-    event_stats = {'cron': 0, 'cron_error': 0, 'cos': 0, 'cos_error': 0}
-    event_history = []
+# As long as passthrough is set the file isn't processed at all, so it is
+# copied straight from the source to the destination bucket within COS.
+# Set passthrough to False once you add processing, so that the file
+# contents are downloaded, processed and uploaded instead.
+# object_metadata is an optional dict (see get_object_metadata()) of what
+# is already known about the file, which saves having to ask COS for it.
+def process_file(cos_client, source_bucket, destination_bucket, file,
+                 passthrough=True, object_metadata=None):
+    transfer_file(cos_client, source_bucket, destination_bucket, file,
+                  passthrough=passthrough, object_metadata=object_metadata)
+
+    try:
+        _log.info('Deleting file %s from bucket %s', file, source_bucket)
+        cos_client.delete_file(bucket_name=source_bucket, file=file)
+    except COSError as e:
+        _log.warning('Error when trying to delete file %s from bucket %s',
+                     file, source_bucket)
+        raise e
+
+
+# transfer_file downloads, processes and uploads the file but leaves it in
+# the source bucket, so that callers handling many files can delete them
+# all at once.
+def transfer_file(cos_client, source_bucket, destination_bucket, file,
+                  passthrough=True, object_metadata=None):
+    if passthrough:
+        _log.info('Copying file %s to COS bucket %s', file, destination_bucket)
+        cos_client.copy_object(
+            source_bucket=source_bucket,
+            source_file=file,
+            destination_bucket=destination_bucket,
+            destination_file=file,
+            size=(object_metadata or {}).get('size'))
+        _log.info('Copy complete')
+        return
+
+    body, length = cos_client.get_object_stream(
+        bucket_name=source_bucket,
+        file=file,
+        size=(object_metadata or {}).get('size'))
+
+    _log.info('File opened')
+    _log.info('Processing file')
+    # body is a stream which is read as the object is uploaded to the
+    # destination bucket (large objects are first downloaded in parts into
+    # a temporary buffer, see get_object_stream()).  To process the
+    # contents you'd wrap body in a file-like object which transforms the
+    # data as it is read (or read it in, process it and store the results
+    # in a file-like object such as io.BytesIO).
+    # This demo program does no actual processing of the file contents.
+    _log.info('Processing complete')
+    _log.info('Uploading file %s to COS bucket %s', file, destination_bucket)
+
+    try:
+        cos_client.put_object_stream(
+            bucket_name=destination_bucket,
+            file=file,
+            body=body,
+            length=length,
+            content_type=(object_metadata or {}).get('content_type'))
+    finally:
+        body.close()
+
+    _log.info('Upload complete')
+
+
+# get_object_metadata extracts the metadata of the uploaded object from the
+# notification included in a COS event, so that it doesn't need to be fetched
+# from COS.  Any value missing from the notification is left out.
+def get_object_metadata(event):
+    notification = event.get('notification') or {}
+    metadata = {}
+    try:
+        metadata['size'] = int(notification['object_length'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    if notification.get('content_type'):
+        metadata['content_type'] = notification['content_type']
+    return metadata
+
+
+# OrJSONProvider makes Flask use orjson, which is considerably faster than
+# the standard json module, both to parse incoming events and to serialize
+# responses.
+class OrJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+def create_server(cos_client=None, destination_bucket=None, source_bucket=None,
+                  history_size=1000, transfer_workers=TRANSFER_WORKERS):
+    event_stats = Counter(cron=0, cron_error=0, cos=0, cos_error=0)
+    stats_lock = threading.Lock()
+    # Only the most recent events are kept, older ones are dropped as new
+    # events arrive.  The lock stops the history from being changed while
+    # it is being read.
+    event_history = deque(maxlen=history_size)
+    history_lock = threading.Lock()
     buckets = [source_bucket, destination_bucket]
+    # A single pool of worker threads carries out the transfers for every
+    # cron event, so overlapping events share one limit on the number of
+    # transfers in flight, and threads are reused rather than started for
+    # each event.  The COS client's connection pool must be sized to leave
+    # room for these workers on top of the request threads (see
+    # start_server()).
+    transfer_executor = ThreadPoolExecutor(max_workers=transfer_workers)
 
     app = Flask(__name__)
+    app.json = OrJSONProvider(app)
+    # Templates never change while the app is running, so compile them once
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache',
+                               'CACHE_DEFAULT_TIMEOUT': 10})
+
+    # Bucket listings are cached for a few seconds so that bursts of requests
+    # for the file inventory don't each have to list every bucket.
+    @cache.memoize(timeout=5)
+    def get_bucket_files(bucket_name):
+        return cos_client.get_files_info(bucket_name=bucket_name)
+
+    # Called once an event has moved files around, so that the file
+    # inventory shows the new state of the buckets straight away.
+    def invalidate_files():
+        cache.delete('files')
+        cache.delete_memoized(get_bucket_files)
+
+    # Events are handled on several threads at once, so counters are only
+    # updated while holding the lock.  Returns the new value of the counter.
+    def count_event(name):
+        with stats_lock:
+            event_stats[name] += 1
+            return event_stats[name]
+
+    # Request IDs of recently handled COS events, mapped to the time they
+    # expire.  All entries live for the same time, so the oldest entries
+    # are always at the front.
+    seen_events = OrderedDict()
+    seen_events_lock = threading.Lock()
+
+    # Records a COS event as handled.  Returns False if the same event was
+    # already handled within the last SEEN_EVENTS_TTL seconds.
+    def mark_event_seen(request_id):
+        now = time.monotonic()
+        with seen_events_lock:
+            while seen_events and (
+                    next(iter(seen_events.values())) <= now or
+                    len(seen_events) >= SEEN_EVENTS_MAX):
+                seen_events.popitem(last=False)
+            if request_id in seen_events:
+                return False
+            seen_events[request_id] = now + SEEN_EVENTS_TTL
+            return True
+
+    def forget_event(request_id):
+        with seen_events_lock:
+            seen_events.pop(request_id, None)
+
+    # Rejected events are counted as errors of the endpoint which received
+    # them.  The event handlers return this response directly rather than
+    # raising an exception with abort(); it is also used for any other bad
+    # request Flask runs into.
+    error_counters = {'handle_cos_event': 'cos_error',
+                      'handle_cron_event': 'cron_error'}
+
+    @app.errorhandler(400)
+    def bad_request(e=None):
+        counter = error_counters.get(request.endpoint)
+        if counter:
+            count_event(counter)
+        return '', 400
 
     # Retrieve a table showing each file known to us, along with its state
     # (present, not present, if present version/size/timestamp) within each
     # known bucket.  We'll use this to build the reconciliation hook for cron
     # events later.
     @app.route('/files', methods=['GET'])
+    @cache.cached(key_prefix='files')
     def get_files():
         file_inventory = {}
         # Check each bucket, get the ObjectSummary listing for that bucket,
         # store in nested dicts filename -> bucket -> file version info for
         # that bucket
-        for b in buckets:
-            bucket_files = cos_client.get_files_info(bucket_name=b)
+        listings = [get_bucket_files(b) for b in buckets]
+        for b, bucket_files in zip(buckets, listings):
             for f, f_info in bucket_files.items():
-                if f not in file_inventory.keys():
-                    file_inventory[f] = {}
-                file_inventory[f][b] = f_info
+                file_inventory.setdefault(f, {})[b] = f_info
+        # COS lists the objects in each bucket in key order, so the sorted
+        # file names can be built by merging the listings rather than by
+        # sorting the whole inventory again.
+        file_names = list(dict.fromkeys(merge(*listings)))
         return render_template('files.html',
-                               file_names=sorted(file_inventory.keys()),
+                               file_names=file_names,
                                files=file_inventory,
                                buckets=buckets)
 
     @app.route('/events/stats', methods=['GET'])
     def get_event_stats():
-        return event_stats
+        with stats_lock:
+            stats = dict(event_stats)
+        return jsonify(stats)
 
     @app.route('/events/history', methods=['GET'])
     def get_event_history():
-        return render_template('history.html', events=event_history)
+        # If a limit is given, only show that many of the most recent events
+        limit = request.args.get('limit', type=int)
+        with history_lock:
+            if limit is None:
+                events = list(event_history)
+            else:
+                events = list(islice(reversed(event_history), max(limit, 0)))
+                events.reverse()
+        # Clients asking for JSON get the raw history rather than a page
+        if request.accept_mimetypes.best_match(
+                ['text/html', 'application/json']) == 'application/json':
+            return jsonify(events)
+        return render_template('history.html', events=events)
 
     @app.route('/events/cos', methods=['POST'])
     def handle_cos_event():
@@ -92,30 +259,45 @@ def create_server(cos_client=None, destination_bucket=None, source_bucket=None):
         if event:
             # We discard events not generated by our configured source bucket
             if event['bucket'] != source_bucket:
-                event_stats['cos_error'] = event_stats['cos_error'] + 1
-                abort(400)
-            event_status = 'OK'
-            event_stats['cos'] = event_stats['cos'] + 1
+                return bad_request()
             source_object = event['key']
+            object_metadata = get_object_metadata(event)
+
+            # COS delivers events at least once, so the same upload may be
+            # reported more than once.  Every write has its own request ID,
+            # which is repeated when its event is redelivered, so remember
+            # the request IDs handled in the last few minutes and ignore any
+            # repeated event for them.  Events without a request ID are
+            # always handled.
+            request_id = (event.get('notification') or {}).get('request_id')
+            if request_id and not mark_event_seen(request_id):
+                _log.info('Ignoring duplicate event for file %s in bucket %s',
+                          source_object, source_bucket)
+                return 'OK'
 
-            logging.info('Event received for file %s in bucket %s',
-                         source_object, source_bucket)
+            event_status = 'OK'
+            event_id = 'cos-' + str(count_event('cos'))
 
-            handler = FileHandler(cos_client=cos_client,
-                                  source_bucket=source_bucket,
-                                  destination_bucket=destination_bucket,
-                                  file=source_object)
+            _log.info('Event received for file %s in bucket %s',
+                      source_object, source_bucket)
 
             try:
-                handler.do()
+                process_file(cos_client, source_bucket, destination_bucket,
+                             source_object, object_metadata=object_metadata)
             except COSError:
                 event_status = 'Deletion Error'
                 # We could return a 500 due to the failure to delete.
                 # If you're customizing this code, you'd need to do a little
                 # bit of refactoring to maintain the event history, etc. if
                 # you decide you want to abort(500) here.
+            except Exception:
+                # The transfer failed, so let a redelivery of this event
+                # try again.
+                if request_id:
+                    forget_event(request_id)
+                raise
             history_event = {
-                'id': 'cos-' + str(event_stats['cos']),
+                'id': event_id,
                 'timestamp': event_timestamp,
                 'objects': [
                     {
@@ -130,14 +312,15 @@ def create_server(cos_client=None, destination_bucket=None, source_bucket=None):
 
             # Update our event history and make sure we store the source
             # bucket name
-            event_history.append(history_event)
+            with history_lock:
+                event_history.append(history_event)
             if source_bucket not in buckets:
                 buckets.append(source_bucket)
 
+            invalidate_files()
             return 'OK'
         else:
-            event_stats['cos_error'] = event_stats['cos_error'] + 1
-            abort(400)
+            return bad_request()
 
     # Any cron event will trigger reconciliation - any file which is present
     # in the source bucket will be assumed not to have been processed,
@@ -150,59 +333,155 @@ def create_server(cos_client=None, destination_bucket=None, source_bucket=None):
         # and probably advisable in a real world application.
         event = request.get_json(silent=True)
         if event:
-            event_stats['cron'] = event_stats['cron'] + 1
+            event_id = 'cron-' + str(count_event('cron'))
             event_timestamp = datetime.now()
             history_event = {
-                'id': 'cron-' + str(event_stats['cron']),
+                'id': event_id,
                 'timestamp': event_timestamp,
                 'objects': []
             }
-            source_inventory = cos_client.get_files_info(
+            # Always list the source bucket afresh rather than using the
+            # cached listing, so we never try to transfer a file which has
+            # already been moved.
+            source_inventory = cos_client.iter_files_info(
                 bucket_name=source_bucket)
-            for file in source_inventory.keys():
-                object_status = 'OK'
-                logging.info('RECONCILE: Processing and transferring %s to %s',
-                             file, destination_bucket)
-                handler = FileHandler(cos_client=cos_client,
-                                      source_bucket=source_bucket,
-                                      destination_bucket=destination_bucket,
-                                      file=file)
 
+            def transfer(file, file_info):
+                log_info = _log.isEnabledFor(logging.INFO)
+                if log_info:
+                    _log.info('RECONCILE: Processing and transferring %s to %s',
+                              file, destination_bucket)
+                object_status = 'OK'
+                # A failed transfer (e.g. the file was moved by a COS event
+                # after we listed it) only affects that file, the rest of the
+                # reconciliation carries on.
                 try:
-                    handler.do()
-                except COSError:
-                    object_status = 'Deletion Error'
-                logging.info(
-                    'RECONCILE: Processing complete for %s', file)
-
-                history_event['objects'].append({
+                    transfer_file(cos_client, source_bucket,
+                                  destination_bucket, file,
+                                  object_metadata={'size': file_info['size']})
+                except Exception:
+                    _log.exception('Error when trying to transfer file %s '
+                                   'from bucket %s', file, source_bucket)
+                    object_status = 'Transfer Error'
+                else:
+                    if log_info:
+                        _log.info(
+                            'RECONCILE: Processing complete for %s', file)
+
+                return {
                     'key': file,
                     'timestamp': datetime.now(),
                     'source_bucket': source_bucket,
                     'destination_bucket': destination_bucket,
                     'status': object_status
-                })
-            event_history.append(history_event)
+                }
+
+            # Transfers spend nearly all of their time waiting on COS, so run
+            # them concurrently on the shared transfer pool.  Each file is
+            # submitted as soon as it has been listed, so transfers overlap
+            # with listing the rest of the bucket.  Results are collected
+            # here, on the request thread, so the history event is only ever
+            # modified by a single thread.
+            # At most two transfers per worker are queued at once,
+            # so a large bucket neither floods the shared pool's queue
+            # (holding up other events) nor gets listed far ahead of the
+            # transfers.  Completed transfers are collected in the order
+            # they finish.
+            in_flight = threading.BoundedSemaphore(
+                2 * transfer_workers)
+            futures = []
+            for file, file_info in source_inventory:
+                in_flight.acquire()
+                future = transfer_executor.submit(transfer, file, file_info)
+                future.add_done_callback(lambda f: in_flight.release())
+                futures.append(future)
+            for future in as_completed(futures):
+                history_event['objects'].append(future.result())
+
+            # Remove every transferred file from the source bucket in as few
+            # requests as possible rather than one request per file.  Files
+            # which failed to transfer are left in place for the next run.
+            transferred = [o['key'] for o in history_event['objects']
+                           if o['status'] == 'OK']
+            if transferred:
+                _log.info('RECONCILE: Deleting %d files from bucket %s',
+                          len(transferred), source_bucket)
+                failed = set(cos_client.delete_files(
+                    bucket_name=source_bucket, files=transferred))
+                for o in history_event['objects']:
+                    if o['key'] in failed:
+                        _log.warning(
+                            'Error when trying to delete file %s from bucket %s',
+                            o['key'], source_bucket)
+                        o['status'] = 'Deletion Error'
+
+            with history_lock:
+                event_history.append(history_event)
+            invalidate_files()
             return 'OK'
         else:
-            event_stats['cron_error'] = event_stats['cron_error'] + 1
-            abort(400)
+            return bad_request()
 
     return app
 
 
+# GunicornApplication runs a WSGI app with gunicorn from within this process,
+# taking its settings from a dict instead of the gunicorn command line.
+class GunicornApplication(BaseApplication):
+    def __init__(self, app, options=None):
+        self.application = app
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+# serve runs the app with gunicorn's threaded worker, so that events are
+# processed concurrently rather than one at a time as with Flask's
+# development server.  The event statistics, history and caches are kept in
+# memory, so we deliberately run a single worker process and scale with
+# threads instead; more processes would each keep their own copy.
+def serve(app, host, port, threads=8):
+    GunicornApplication(app, {
+        'bind': '%s:%d' % (host, port),
+        'workers': 1,
+        'worker_class': 'gthread',
+        'threads': threads,
+        'keepalive': 75
+    }).run()
+
+
+# Options with an envvar can also be set with that environment variable,
+# which is how the app is configured when deployed (Code Engine sets PORT).
 @click.command()
-@click.option('-d', '--destination-bucket', help='Destination bucket for processing output')
-@click.option('-s', '--source-bucket', help='Source bucket for input')
-@click.option('-x', '--cos-instance-id', help='COS instance ID')
-@click.option('-e', '--cos-endpoint', help='COS endpoint URL')
-@click.option('-i', '--iam-endpoint', help='IAM token endpoint')
-@click.option('-k', '--api-key', help='IAM API key')
-@click.option('-p', '--port', default=8080,
+@click.option('-d', '--destination-bucket', envvar='DESTINATION_BUCKET',
+              help='Destination bucket for processing output')
+@click.option('-s', '--source-bucket', envvar='SOURCE_BUCKET',
+              help='Source bucket for input')
+@click.option('-x', '--cos-instance-id', envvar='COS_INSTANCE_ID',
+              help='COS instance ID')
+@click.option('-e', '--cos-endpoint', envvar='COS_ENDPOINT',
+              help='COS endpoint URL')
+@click.option('-i', '--iam-endpoint', envvar='IAM_ENDPOINT',
+              help='IAM token endpoint')
+@click.option('-k', '--api-key', envvar='APIKEY', help='IAM API key')
+@click.option('-p', '--port', default=8080, envvar='PORT',
               help='HTTP listener port (defaults to 8080)')
 @click.option('-h', '--host', default='0.0.0.0',
               help='Host IP address (set to 127.0.0.1 to disable remote connections, default is 0.0.0.0)')
+@click.option('-m', '--history-size', type=int, default=1000,
+              envvar='EVENT_HISTORY_MAX',
+              help='Number of events kept in the event history (defaults to 1000)')
+@click.option('-t', '--threads', default=8,
+              help='Number of threads handling requests (defaults to 8)')
 @click.option('-l', '--log-level', default='info',
+              type=click.Choice(['debug', 'info', 'warning', 'error',
+                                 'critical'], case_sensitive=False),
               help='Log level (debug|info|warning|error|critical).  The default is info.')
 def start_server(destination_bucket,
                  source_bucket,
@@ -212,67 +491,53 @@ def start_server(destination_bucket,
                  api_key,
                  port,
                  host,
+                 history_size,
+                 threads,
                  log_level):
     """Demo app for processing files and moving between buckets."""
 
-    log_levels = {
-        'debug': logging.DEBUG,
-        'info': logging.INFO,
-        'warning': logging.WARNING,
-        'error': logging.ERROR,
-        'critical': logging.CRITICAL
-    }
-    logging.basicConfig(level=log_levels[log_level])
-    # Get our config/arguments
-
-    # TODO: Move to click-based environment var handling
-    cos_endpoint = cos_endpoint if cos_endpoint else environ.get(
-        'COS_ENDPOINT')
-    if not cos_endpoint:
-        logging.error('No valid COS endpoint specified')
-        return -1
-
-    api_key = api_key if api_key else environ.get('APIKEY')
-    if not api_key:
-        logging.error('No IAM API key found')
-        return -1
-
-    destination_bucket = destination_bucket if destination_bucket else environ.get(
-        'DESTINATION_BUCKET')
-    if not destination_bucket:
-        logging.error('Must specify a destination bucket')
-        return -1
-
-    source_bucket = source_bucket if source_bucket else environ.get(
-        'SOURCE_BUCKET')
-    if not source_bucket:
-        logging.error('Must specify a source bucket')
-        return -1
-
-    cos_instance_id = cos_instance_id if cos_instance_id else environ.get(
-        'COS_INSTANCE_ID')
-    if not cos_instance_id:
-        logging.error('No COS instance ID found')
-        return -1
-
-    iam_endpoint = iam_endpoint if iam_endpoint else environ.get(
-        'IAM_ENDPOINT')
-    if not iam_endpoint:
-        logging.error('No IAM endpoint specified')
-        return -1
+    # Timestamps to the second are plenty for this app, so skip formatting
+    # the milliseconds of every record.
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=log_level.upper(),
+                        force=True)
+
+    required = [
+        (cos_endpoint, 'No valid COS endpoint specified'),
+        (api_key, 'No IAM API key found'),
+        (destination_bucket, 'Must specify a destination bucket'),
+        (source_bucket, 'Must specify a source bucket'),
+        (cos_instance_id, 'No COS instance ID found'),
+        (iam_endpoint, 'No IAM endpoint specified')
+    ]
+    for value, message in required:
+        if not value:
+            _log.error(message)
+            return -1
+
+    # Every request thread and every transfer worker may be making a request
+    # to COS, while the shared transfer manager transfers up to
+    # MAX_TRANSFER_CONCURRENCY parts, so size the connection pool for all of
+    # them to hold a connection.
+    max_pool_connections = max(
+        MAX_POOL_CONNECTIONS,
+        threads + TRANSFER_WORKERS + MAX_TRANSFER_CONCURRENCY)
 
     cos_client = CloudObjectStorage(
         api_key=api_key,
         instance_id=cos_instance_id,
         iam_endpoint=iam_endpoint,
-        cos_endpoint=cos_endpoint)
+        cos_endpoint=cos_endpoint,
+        max_pool_connections=max_pool_connections)
 
-    logging.info('Starting cos-2-cos server')
+    _log.info('Starting cos-2-cos server')
 
     server = create_server(cos_client=cos_client,
                            destination_bucket=destination_bucket,
-                           source_bucket=source_bucket)
-    server.run(port=port)
+                           source_bucket=source_bucket,
+                           history_size=history_size)
+    serve(server, host, port, threads=threads)
 
 
 if __name__ == "__main__":
@@ -6,7 +6,10 @@ setup(
     packages=find_packages(),
     install_requires=[
         'click',
-        'flask',
+        'flask>=2.2',
+        'flask-caching',
+        'gunicorn',
+        'orjson',
         'requests',
         'ibm-cos-sdk'
     ],